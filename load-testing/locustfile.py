@@ -1,4 +1,5 @@
-import json
+import orjson
+import numpy as np
 import random
 import time
 import uuid
@@ -6,8 +7,8 @@ from typing import Dict, List, Optional
 import asyncio
 import websockets
 import requests
-from locust import HttpUser, task, between, events
-from locust.contrib.fasthttp import FastHttpUser
+import httpx
+from locust import User, task, between, events
 from locust.exception import RescheduleTask
 import logging
 from dotenv import load_dotenv
@@ -17,6 +18,31 @@ load_dotenv('../.env')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+TEST_MESSAGES = [
+    "Hello, how are you?",
+    "Can you explain quantum computing?",
+    "What's the weather like today?",
+    "Tell me a joke",
+    "How do I cook pasta?",
+    "What's the meaning of life?",
+    "Explain machine learning in simple terms",
+    "What are the benefits of exercise?",
+    "How does photosynthesis work?",
+    "What's your favorite color?",
+    "Can you write a detailed explanation about the history of artificial intelligence, including major milestones, key researchers, and how it has evolved over the decades?",
+    "Please provide a comprehensive guide on how to build a web application from scratch, including frontend, backend, database design, and deployment strategies.",
+]
+
+_RNG = np.random.default_rng()
+
+def _message_batcher(k: int = 4096):
+    # Sample k messages per RNG call and hand them out one at a time
+    while True:
+        yield from _RNG.choice(TEST_MESSAGES, size=k).tolist()
+
+_MSG_ITER = _message_batcher()
 
 class CentrifugoWebSocketClient:
     def __init__(self, ws_url: str, token: str):
@@ -29,7 +55,7 @@ class CentrifugoWebSocketClient:
 
     async def connect(self):
         try:
-            self.websocket = await websockets.connect(self.ws_url)
+            self.websocket = await websockets.connect(self.ws_url, ping_interval=20, ping_timeout=20)
             self.connected = True
             logger.info("WebSocket connected successfully")
             connect_msg = {
@@ -39,7 +65,7 @@ class CentrifugoWebSocketClient:
                     "name": "loadtest"
                 }
             }
-            await self.websocket.send(json.dumps(connect_msg))
+            await self.websocket.send(orjson.dumps(connect_msg).decode())
             response = await self.websocket.recv()
             logger.info(f"Connect response: {response}")
         except Exception as e:
@@ -57,28 +83,24 @@ class CentrifugoWebSocketClient:
                 "channel": channel
             }
         }
-        await self.websocket.send(json.dumps(subscribe_msg))
+        await self.websocket.send(orjson.dumps(subscribe_msg).decode())
         response = await self.websocket.recv()
         self.subscriptions[channel] = sub_id
         logger.info(f"Subscribed to {channel}: {response}")
 
     async def listen_for_messages(self, timeout: float = 30.0):
-        start_time = time.time()
         messages_received = 0
         try:
-            while time.time() - start_time < timeout:
-                try:
-                    message = await asyncio.wait_for(self.websocket.recv(), timeout=1.0)
+            async with asyncio.timeout(timeout):
+                while True:
+                    message = await self.websocket.recv()
                     messages_received += 1
                     self.message_count += 1
-                    logger.debug(f"Received message: {message}")
-                except asyncio.TimeoutError:
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving message: {e}")
-                    break
+                    logger.debug("Received message: %s", message)
+        except TimeoutError:
+            pass
         except Exception as e:
-            logger.error(f"Error in listen_for_messages: {e}")
+            logger.error(f"Error receiving message: {e}")
         return messages_received
 
     async def disconnect(self):
@@ -86,59 +108,91 @@ class CentrifugoWebSocketClient:
             await self.websocket.close()
             self.connected = False
 
-class ChatLoadTestUser(FastHttpUser):
+class Http2User(User):
+    abstract = True
+
+    def on_start(self):
+        # One connection per user so HPACK state and cwnd carry across requests
+        self._h2 = httpx.Client(
+            http2=True,
+            base_url=self.host,
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        )
+
+    def on_stop(self):
+        self._h2.close()
+
+    def h2_request(self, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        start_time = time.perf_counter()
+        response = None
+        exception = None
+        try:
+            response = self._h2.request(method, path, **kwargs)
+            if response.status_code != 200:
+                exception = Exception(f"Status code: {response.status_code}")
+        except httpx.HTTPError as e:
+            exception = e
+        self.environment.events.request.fire(
+            request_type=method,
+            name=path,
+            response_time=(time.perf_counter() - start_time) * 1000,
+            response_length=len(response.content) if response is not None else 0,
+            response=response,
+            context={},
+            exception=exception
+        )
+        return response
+
+class ChatLoadTestUser(Http2User):
     wait_time = between(1, 3)
 
     def on_start(self):
+        super().on_start()
         self.chat_id = str(uuid.uuid4())
         self.user_id = f"user_{random.randint(1000, 9999)}"
         self.token = None
         self.ws_client = None
         self.messages_sent = 0
         self.messages_received = 0
+        # Only the message text varies per request, so template the rest once
+        template = orjson.dumps({
+            "id": self.chat_id,
+            "messages": [{"role": "user", "parts": [{"type": "text", "text": "__T__"}]}]
+        })
+        self._payload_prefix, self._payload_suffix = template.split(b'"__T__"')
         self.get_centrifugo_token()
 
     def get_centrifugo_token(self):
         try:
-            with self.client.get("/api/centrifugo-token", catch_response=True) as response:
-                if response.status_code == 200:
-                    self.token = response.json()["token"]
-                    logger.info(f"Got token for user {self.user_id}")
-                    response.success()
-                else:
-                    logger.error(f"Failed to get token: {response.status_code}")
-                    response.failure(f"Token request failed: {response.status_code}")
+            response = self.h2_request("GET", "/api/centrifugo-token")
+            if response is not None and response.status_code == 200:
+                self.token = orjson.loads(response.content)["token"]
+                logger.info(f"Got token for user {self.user_id}")
+            elif response is not None:
+                logger.error(f"Failed to get token: {response.status_code}")
         except Exception as e:
             logger.error(f"Error getting token: {e}")
-            self.client.get("/api/centrifugo-token", catch_response=True).failure(f"Exception: {str(e)}")
 
     @task(3)
     def send_chat_message(self):
         if not self.token:
             self.get_centrifugo_token()
             return
-        messages = [
-            {
-                "role": "user",
-                "parts": [{"type": "text", "text": self.generate_test_message()}]
-            }
-        ]
-        payload = {
-            "id": self.chat_id,
-            "messages": messages
-        }
+        body = self._payload_prefix + orjson.dumps(self.generate_test_message()) + self._payload_suffix
         try:
-            with self.client.post("/api/chat", json=payload, catch_response=True) as response:
-                if response.status_code == 200:
-                    data = response.json()
-                    channel = data.get("channel")
-                    message_id = data.get("messageId")
-                    self.messages_sent += 1
-                    logger.info(f"Sent message to channel {channel}, messageId: {message_id}")
-                    response.success()
-                else:
-                    logger.error(f"Chat request failed: {response.status_code}")
-                    response.failure(f"Status code: {response.status_code}")
+            response = self.h2_request(
+                "POST", "/api/chat",
+                content=body,
+                headers={"Content-Type": "application/json"}
+            )
+            if response is not None and response.status_code == 200:
+                data = orjson.loads(response.content)
+                channel = data.get("channel")
+                message_id = data.get("messageId")
+                self.messages_sent += 1
+                logger.info("Sent message to channel %s, messageId: %s", channel, message_id)
+            elif response is not None:
+                logger.error(f"Chat request failed: {response.status_code}")
         except Exception as e:
             logger.error(f"Error sending chat message: {e}")
 
@@ -146,26 +200,13 @@ class ChatLoadTestUser(FastHttpUser):
     # to avoid asyncio event loop conflicts with Locust
 
     def generate_test_message(self) -> str:
-        messages = [
-            "Hello, how are you?",
-            "Can you explain quantum computing?",
-            "What's the weather like today?",
-            "Tell me a joke",
-            "How do I cook pasta?",
-            "What's the meaning of life?",
-            "Explain machine learning in simple terms",
-            "What are the benefits of exercise?",
-            "How does photosynthesis work?",
-            "What's your favorite color?",
-            "Can you write a detailed explanation about the history of artificial intelligence, including major milestones, key researchers, and how it has evolved over the decades?",
-            "Please provide a comprehensive guide on how to build a web application from scratch, including frontend, backend, database design, and deployment strategies.",
-        ]
-        return random.choice(messages)
+        return next(_MSG_ITER)
 
-class ReconnectionTestUser(FastHttpUser):
+class ReconnectionTestUser(Http2User):
     wait_time = between(2, 5)
 
     def on_start(self):
+        super().on_start()
         self.chat_id = str(uuid.uuid4())
         self.user_id = f"reconnect_user_{random.randint(1000, 9999)}"
         self.connection_attempts = 0
@@ -190,9 +231,9 @@ class ReconnectionTestUser(FastHttpUser):
     def simulate_page_reload(self):
         logger.info(f"Simulating page reload for user {self.user_id}")
         self.send_message("Before page reload")
-        response = self.client.get("/api/centrifugo-token")
-        if response.status_code == 200:
-            new_token = response.json()["token"]
+        response = self.h2_request("GET", "/api/centrifugo-token")
+        if response is not None and response.status_code == 200:
+            new_token = orjson.loads(response.content)["token"]
             logger.info(f"Got new token after reload: {new_token[:20]}...")
         self.send_message("After page reload")
 
@@ -212,9 +253,11 @@ class ReconnectionTestUser(FastHttpUser):
         messages = [{"role": "user", "parts": [{"type": "text", "text": text}]}]
         payload = {"id": self.chat_id, "messages": messages}
         try:
-            response = self.client.post("/api/chat", json=payload)
+            response = self.h2_request("POST", "/api/chat", json=payload)
+            if response is None:
+                return
             if response.status_code == 200:
-                logger.info(f"Sent message: {text[:50]}...")
+                logger.info("Sent message: %.50s...", text)
             else:
                 logger.error(f"Failed to send message: {response.status_code}")
         except Exception as e:
@@ -1,26 +1,61 @@
 import asyncio
 import json
+import orjson
 import logging
 import time
-import requests
+import httpx
+import numpy as np
 from typing import Dict, Any
 import signal
-import sys
 from dotenv import load_dotenv
 import os
+import msgspec
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 load_dotenv('../.env')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+class Node(msgspec.Struct):
+    num_clients: int = 0
+    num_channels: int = 0
+    num_subscriptions: int = msgspec.field(name="num_subs", default=0)
+    uid: str = ""
+
+class Info(msgspec.Struct):
+    nodes: list[Node] = []
+
+class StatsResp(msgspec.Struct):
+    result: Info = msgspec.field(default_factory=Info)
 
 class CentrifugoMonitor:
     def __init__(self, centrifugo_url: str = "http://localhost:8000",
-                 api_key: str = None):
+                 api_key: str = None, history_size: int = 8640):
         self.centrifugo_url = centrifugo_url
         self.api_key = api_key or self.get_api_key()
         self.running = True
-        self.metrics_history = []
+        self._stop = asyncio.Event()
+        self.history_size = history_size
+        self._latest = {}
+        # Numeric columns kept in ring buffers indexed by self._i % history_size
+        self._ts = np.empty(history_size, dtype=np.float64)
+        self._conn = np.empty(history_size, dtype=np.int32)
+        self._chan = np.empty(history_size, dtype=np.int32)
+        self._i = 0
+        self._client = httpx.AsyncClient(
+            http2=True,
+            base_url=self.centrifugo_url,
+            headers={
+                "Authorization": f"apikey {self.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
 
     def get_api_key(self) -> str:
         try:
@@ -31,39 +66,23 @@ class CentrifugoMonitor:
             logger.error(f"Failed to get API key: {e}")
             return ""
 
-    def get_centrifugo_stats(self) -> Dict[str, Any]:
+    async def get_centrifugo_stats(self) -> StatsResp:
         try:
-            headers = {
-                "Authorization": f"apikey {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.post(
-                f"{self.centrifugo_url}/api/info",
-                headers=headers,
-                json={}
-            )
+            response = await self._client.post("/api/info", json={})
             if response.status_code == 200:
-                return response.json()
+                return msgspec.json.decode(response.content, type=StatsResp)
             else:
                 logger.error(f"Failed to get stats: {response.status_code}")
-                return {}
+                return StatsResp()
         except Exception as e:
             logger.error(f"Error getting Centrifugo stats: {e}")
-            return {}
+            return StatsResp()
 
-    def get_channels_info(self) -> Dict[str, Any]:
+    async def get_channels_info(self) -> Dict[str, Any]:
         try:
-            headers = {
-                "Authorization": f"apikey {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.post(
-                f"{self.centrifugo_url}/api/channels",
-                headers=headers,
-                json={}
-            )
+            response = await self._client.post("/api/channels", json={})
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
                 logger.error(f"Failed to get channels: {response.status_code}")
                 return {}
@@ -76,36 +95,61 @@ class CentrifugoMonitor:
         while self.running:
             try:
                 timestamp = time.time()
-                stats = self.get_centrifugo_stats()
-                channels = self.get_channels_info()
+                stats, channels = await asyncio.gather(
+                    self.get_centrifugo_stats(),
+                    self.get_channels_info()
+                )
                 metrics = {
                     'timestamp': timestamp,
                     'stats': stats,
                     'channels': channels,
                     'channel_count': len(channels.get('result', {}).get('channels', [])),
-                    'total_connections': stats.get('result', {}).get('nodes', [{}])[0].get('num_clients', 0) if stats.get('result', {}).get('nodes') else 0
+                    'total_connections': stats.result.nodes[0].num_clients if stats.result.nodes else 0
                 }
-                self.metrics_history.append(metrics)
+                self._latest = metrics
+                self.record_sample(metrics)
                 logger.info(f"Connections: {metrics['total_connections']}, "
                            f"Channels: {metrics['channel_count']}")
-                if len(self.metrics_history) % 6 == 0:
+                if self._i % 6 == 0:
                     self.print_detailed_stats(metrics)
-                await asyncio.sleep(interval)
+                await self.wait_for_stop(interval)
             except Exception as e:
                 logger.error(f"Error in monitoring loop: {e}")
-                await asyncio.sleep(interval)
+                await self.wait_for_stop(interval)
+
+    async def wait_for_stop(self, timeout: float):
+        try:
+            async with asyncio.timeout(timeout):
+                await self._stop.wait()
+        except TimeoutError:
+            pass
+
+    def record_sample(self, metrics: Dict[str, Any]):
+        slot = self._i % self.history_size
+        self._ts[slot] = metrics['timestamp']
+        self._conn[slot] = metrics['total_connections']
+        self._chan[slot] = metrics['channel_count']
+        self._i += 1
+
+    def recent_indices(self, count: int) -> np.ndarray:
+        count = min(count, self._i, self.history_size)
+        return np.arange(self._i - count, self._i) % self.history_size
 
     def print_detailed_stats(self, metrics: Dict[str, Any]):
         logger.info("=== Detailed Centrifugo Stats ===")
-        stats = metrics.get('stats', {}).get('result', {})
-        if stats:
-            nodes = stats.get('nodes', [])
-            if nodes:
-                node = nodes[0]
-                logger.info(f"Node ID: {node.get('uid', 'unknown')}")
-                logger.info(f"Clients: {node.get('num_clients', 0)}")
-                logger.info(f"Channels: {node.get('num_channels', 0)}")
-                logger.info(f"Subscriptions: {node.get('num_subscriptions', 0)}")
+        window = self.recent_indices(6)
+        if window.size:
+            conn = self._conn[window]
+            chan = self._chan[window]
+            logger.info(f"Connections (last {window.size}): mean {conn.mean():.1f}, max {conn.max()}")
+            logger.info(f"Channels (last {window.size}): mean {chan.mean():.1f}, max {chan.max()}")
+        nodes = metrics['stats'].result.nodes if 'stats' in metrics else []
+        if nodes:
+            node = nodes[0]
+            logger.info(f"Node ID: {node.uid or 'unknown'}")
+            logger.info(f"Clients: {node.num_clients}")
+            logger.info(f"Channels: {node.num_channels}")
+            logger.info(f"Subscriptions: {node.num_subscriptions}")
         channels = metrics.get('channels', {}).get('result', {}).get('channels', [])
         if channels:
             logger.info(f"Active channels: {len(channels)}")
@@ -116,30 +160,45 @@ class CentrifugoMonitor:
         if not filename:
             timestamp = int(time.time())
             filename = f"centrifugo_metrics_{timestamp}.json"
+        history_file = os.path.splitext(filename)[0] + ".npz"
         try:
-            with open(filename, 'w') as f:
-                json.dump(self.metrics_history, f, indent=2)
-            logger.info(f"Metrics saved to {filename}")
+            with open(filename, 'wb') as f:
+                f.write(orjson.dumps(self._latest, default=msgspec.to_builtins, option=orjson.OPT_INDENT_2))
+            history = self.recent_indices(self.history_size)
+            np.savez_compressed(
+                history_file,
+                timestamp=self._ts[history],
+                total_connections=self._conn[history],
+                channel_count=self._chan[history]
+            )
+            logger.info(f"Metrics saved to {filename} and {history_file}")
         except Exception as e:
             logger.error(f"Failed to save metrics: {e}")
 
+    async def close(self):
+        await self._client.aclose()
+
     def stop(self):
         self.running = False
+        self._stop.set()
         logger.info("Stopping monitor...")
 
-def signal_handler(signum, frame):
-    logger.info("Received interrupt signal")
-    sys.exit(0)
-
 async def main():
-    signal.signal(signal.SIGINT, signal_handler)
     monitor = CentrifugoMonitor()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, monitor.stop)
+    except NotImplementedError:
+        # Windows event loops have no add_signal_handler
+        signal.signal(signal.SIGINT, lambda *_: loop.call_soon_threadsafe(monitor.stop))
     try:
         await monitor.monitor_loop()
-    except KeyboardInterrupt:
-        logger.info("Monitoring interrupted")
     finally:
         monitor.save_metrics()
+        await monitor.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -27,7 +27,7 @@ check_service "http://localhost:8000/api" "Centrifugo"
 echo ""
 echo "Checking Python dependencies..."
 # change this to your local python path
-/Library/Frameworks/Python.framework/Versions/3.13/bin/python3 -c "import locust, websockets, requests, psutil, dotenv; print('All dependencies available')"
+/Library/Frameworks/Python.framework/Versions/3.13/bin/python3 -c "import locust, websockets, aiohttp, requests, httpx, h2, orjson, numpy, msgspec, psutil, dotenv; print('All dependencies available')"
 
 echo ""
 echo "Test Plan Overview:"
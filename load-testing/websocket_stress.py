@@ -1,25 +1,49 @@
 import asyncio
-import json
+import functools
+import orjson
 import logging
 import random
 import time
 import uuid
 from typing import Dict, List, Optional
-import websockets
-import requests
+import aiohttp
 from concurrent.futures import ThreadPoolExecutor
 import signal
 import sys
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv('../.env')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Simulated issues that wait longer than this for a worker are dropped
+ISSUE_MAX_DELAY_NS = 5_000_000_000
+
+@functools.lru_cache(maxsize=1024)
+def _build_connect_frame(token: str, client_name: str) -> str:
+    return orjson.dumps({"id": 1, "connect": {"token": token, "name": client_name}}).decode()
+
+@functools.lru_cache(maxsize=1024)
+def _build_subscribe_frame(channel: str) -> str:
+    return orjson.dumps({"id": 2, "subscribe": {"channel": channel}}).decode()
+
+async def _receive_text(websocket: aiohttp.ClientWebSocketResponse) -> str:
+    msg = await websocket.receive()
+    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                    aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+        raise ConnectionResetError(f"WebSocket closed ({msg.type.name})")
+    return msg.data
+
 class CentrifugoStressTester:
     def __init__(self, backend_url: str = "http://localhost:8787",
-                 ws_url: str = "ws://localhost:3000/centrifugo/connection/websocket"):
+                 ws_url: str = "ws://localhost:3000/centrifugo/connection/websocket",
+                 token_ttl: float = 300.0):
         self.backend_url = backend_url
         self.ws_url = ws_url
         self.clients = []
@@ -32,81 +56,148 @@ class CentrifugoStressTester:
             'errors': 0
         }
         self.running = True
+        self._session = None
+        # Stress clients all connect as the same user, so one token serves the run
+        self.token_ttl = token_ttl
+        self._token_cache = {}
+        self._token_fetches = {}
+        # Simulated client issues run off the receive path; drops when full
+        self._issue_q = asyncio.Queue(maxsize=1000)
+        # Cleared while a simulated issue has a client paused
+        self._client_resume = {}
+        # Clients with an issue queued or running; at most one per client
+        self._issue_pending = set()
+
+    async def start(self):
+        # Open websockets hold a connector slot for their whole lifetime, so the
+        # default 100-connection cap would starve handshakes and HTTP calls
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
 
-    def get_token(self) -> str:
+    async def get_token(self, user_key: str = "anonymous") -> str:
+        cached = self._token_cache.get(user_key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        # Concurrent callers for the same key share one fetch and its outcome
+        pending = self._token_fetches.get(user_key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_token(user_key))
+            self._token_fetches[user_key] = pending
+            pending.add_done_callback(lambda _: self._token_fetches.pop(user_key, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch_token(self, user_key: str) -> str:
         try:
-            response = requests.get(f"{self.backend_url}/api/centrifugo-token")
-            if response.status_code == 200:
-                return response.json()["token"]
-            else:
-                raise Exception(f"Failed to get token: {response.status_code}")
+            async with self._session.get(
+                f"{self.backend_url}/api/centrifugo-token", params={"userId": user_key}
+            ) as response:
+                if response.status == 200:
+                    token = (await response.json(loads=orjson.loads))["token"]
+                else:
+                    raise Exception(f"Failed to get token: {response.status}")
         except Exception as e:
             logger.error(f"Error getting token: {e}")
             raise
+        self._token_cache[user_key] = (token, time.monotonic() + self.token_ttl)
+        return token
 
     async def create_websocket_client(self, client_id: str, chat_id: str):
-        token = self.get_token()
+        try:
+            token = await self.get_token()
+        except Exception:
+            self.stats['connections_failed'] += 1
+            return
+        connect_frame = _build_connect_frame(token, f"stress_client_{client_id}")
+        subscribe_frame = _build_subscribe_frame(f"chat:{chat_id}")
+        resume = self._client_resume[client_id] = asyncio.Event()
+        resume.set()
         reconnect_attempts = 0
         max_reconnects = 5
-        while self.running and reconnect_attempts < max_reconnects:
-            try:
-                logger.info(f"Client {client_id}: Connecting (attempt {reconnect_attempts + 1})")
-                websocket = await websockets.connect(self.ws_url)
-                self.stats['connections_created'] += 1
-                connect_msg = {
-                    "id": 1,
-                    "connect": {"token": token, "name": f"stress_client_{client_id}"}
-                }
-                await websocket.send(json.dumps(connect_msg))
-                response = await websocket.recv()
-                logger.debug(f"Client {client_id}: Connect response: {response}")
-                channel = f"chat:{chat_id}"
-                subscribe_msg = {
-                    "id": 2,
-                    "subscribe": {"channel": channel}
-                }
-                await websocket.send(json.dumps(subscribe_msg))
-                response = await websocket.recv()
-                logger.debug(f"Client {client_id}: Subscribe response: {response}")
-                await self.listen_for_messages(websocket, client_id, chat_id)
-            except websockets.exceptions.ConnectionClosed:
-                logger.warning(f"Client {client_id}: Connection closed")
-                reconnect_attempts += 1
-                self.stats['reconnections'] += 1
-                await asyncio.sleep(random.uniform(1, 3))
-            except Exception as e:
-                logger.error(f"Client {client_id}: Error: {e}")
-                self.stats['errors'] += 1
-                reconnect_attempts += 1
-                await asyncio.sleep(random.uniform(1, 3))
+        try:
+            while self.running and reconnect_attempts < max_reconnects:
+                try:
+                    logger.info(f"Client {client_id}: Connecting (attempt {reconnect_attempts + 1})")
+                    async with self._session.ws_connect(self.ws_url, heartbeat=20) as websocket:
+                        self.stats['connections_created'] += 1
+                        await websocket.send_str(connect_frame)
+                        response = await _receive_text(websocket)
+                        logger.debug("Client %s: Connect response: %s", client_id, response)
+                        await websocket.send_str(subscribe_frame)
+                        response = await _receive_text(websocket)
+                        logger.debug("Client %s: Subscribe response: %s", client_id, response)
+                        await self.listen_for_messages(websocket, client_id, chat_id)
+                except (ConnectionResetError, aiohttp.ClientConnectionError):
+                    logger.warning(f"Client {client_id}: Connection closed")
+                    reconnect_attempts += 1
+                    self.stats['reconnections'] += 1
+                    await asyncio.sleep(random.uniform(1, 3))
+                except Exception as e:
+                    logger.error(f"Client {client_id}: Error: {e}")
+                    self.stats['errors'] += 1
+                    reconnect_attempts += 1
+                    await asyncio.sleep(random.uniform(1, 3))
+        finally:
+            self._client_resume.pop(client_id, None)
         if reconnect_attempts >= max_reconnects:
             logger.error(f"Client {client_id}: Max reconnection attempts reached")
             self.stats['connections_failed'] += 1
 
+    async def _delayed_start(self, index: int, chat_id: str):
+        # Stagger handshakes so large runs don't hit Centrifugo all at once
+        await asyncio.sleep(index * 0.01 + random.uniform(0, 0.05))
+        await self.create_websocket_client(f"client_{index}", chat_id)
+
     async def listen_for_messages(self, websocket, client_id: str, chat_id: str):
         message_count = 0
-        last_message_time = time.time()
+        last_message_ns = time.monotonic_ns()
+        resume = self._client_resume[client_id]
         try:
             while self.running:
+                await resume.wait()
+                if not self.running:
+                    break
                 try:
-                    message = await asyncio.wait_for(websocket.recv(), timeout=30.0)
+                    async with asyncio.timeout(30.0):
+                        message = await _receive_text(websocket)
                     message_count += 1
                     self.stats['messages_received'] += 1
-                    last_message_time = time.time()
-                    logger.debug(f"Client {client_id}: Received message {message_count}")
-                    if random.random() < 0.01:
-                        await self.simulate_client_issue(websocket, client_id)
-                except asyncio.TimeoutError:
-                    if time.time() - last_message_time > 30:
-                        logger.warning(f"Client {client_id}: No messages for 30s, sending ping")
-                        await websocket.ping()
-                except websockets.exceptions.ConnectionClosed:
+                    last_message_ns = time.monotonic_ns()
+                    logger.debug("Client %s: Received message %d", client_id, message_count)
+                    if random.random() < 0.01 and client_id not in self._issue_pending:
+                        try:
+                            self._issue_q.put_nowait((websocket, client_id, time.monotonic_ns()))
+                            self._issue_pending.add(client_id)
+                        except asyncio.QueueFull:
+                            pass
+                except TimeoutError:
+                    if time.monotonic_ns() - last_message_ns > 30_000_000_000:
+                        logger.warning(f"Client {client_id}: No messages for 30s")
+                except ConnectionResetError:
                     logger.warning(f"Client {client_id}: Connection closed during listen")
                     break
         except Exception as e:
             logger.error(f"Client {client_id}: Listen error: {e}")
             raise
 
+    async def _issue_worker(self):
+        while self.running:
+            websocket, client_id, queued_ns = await self._issue_q.get()
+            try:
+                # Only apply issues to the connection that triggered them, and only
+                # while they are still fresh
+                if (self.running and not websocket.closed
+                        and time.monotonic_ns() - queued_ns < ISSUE_MAX_DELAY_NS):
+                    await self.simulate_client_issue(websocket, client_id)
+                else:
+                    logger.debug("Client %s: Skipping stale simulated issue", client_id)
+            finally:
+                self._issue_pending.discard(client_id)
+                self._issue_q.task_done()
+
     async def simulate_client_issue(self, websocket, client_id: str):
         issues = [
             self.simulate_network_lag,
@@ -116,17 +207,27 @@ class CentrifugoStressTester:
         issue = random.choice(issues)
         await issue(websocket, client_id)
 
+    async def _pause_client(self, client_id: str, duration: float):
+        resume = self._client_resume.get(client_id)
+        if resume is None or not self.running:
+            return
+        resume.clear()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            resume.set()
+
     async def simulate_network_lag(self, websocket, client_id: str):
         logger.info(f"Client {client_id}: Simulating network lag")
-        await asyncio.sleep(random.uniform(2, 8))
+        await self._pause_client(client_id, random.uniform(2, 8))
 
     async def simulate_tab_switch(self, websocket, client_id: str):
         logger.info(f"Client {client_id}: Simulating tab switch")
-        await asyncio.sleep(random.uniform(0.5, 2))
+        await self._pause_client(client_id, random.uniform(0.5, 2))
 
     async def simulate_mobile_background(self, websocket, client_id: str):
         logger.info(f"Client {client_id}: Simulating mobile background")
-        await asyncio.sleep(random.uniform(10, 30))
+        await self._pause_client(client_id, random.uniform(10, 30))
 
     async def send_chat_messages(self, chat_id: str, num_messages: int = 10):
         for i in range(num_messages):
@@ -136,36 +237,40 @@ class CentrifugoStressTester:
                     "parts": [{"type": "text", "text": f"Stress test message {i + 1}"}]
                 }]
                 payload = {"id": chat_id, "messages": messages}
-                response = requests.post(f"{self.backend_url}/api/chat", json=payload)
-                if response.status_code == 200:
-                    self.stats['messages_sent'] += 1
-                    logger.info(f"Sent message {i + 1} to chat {chat_id}")
-                else:
-                    logger.error(f"Failed to send message: {response.status_code}")
+                async with self._session.post(f"{self.backend_url}/api/chat", json=payload) as response:
+                    if response.status == 200:
+                        self.stats['messages_sent'] += 1
+                        logger.info("Sent message %d to chat %s", i + 1, chat_id)
+                    else:
+                        logger.error(f"Failed to send message: {response.status}")
                 await asyncio.sleep(random.uniform(2, 5))
             except Exception as e:
                 logger.error(f"Error sending message: {e}")
                 self.stats['errors'] += 1
 
-    async def run_stress_test(self, num_clients: int = 10, num_chats: int = 3, duration: int = 300):
+    async def run_stress_test(self, num_clients: int = 10, num_chats: int = 3, duration: int = 300,
+                              num_issue_workers: int = 4):
         logger.info(f"Starting stress test: {num_clients} clients, {num_chats} chats, {duration}s duration")
         chat_ids = [str(uuid.uuid4()) for _ in range(num_chats)]
-        client_tasks = []
-        for i in range(num_clients):
-            chat_id = random.choice(chat_ids)
-            task = asyncio.create_task(
-                self.create_websocket_client(f"client_{i}", chat_id)
-            )
-            client_tasks.append(task)
-        message_tasks = []
-        for chat_id in chat_ids:
-            task = asyncio.create_task(
-                self.send_chat_messages(chat_id, num_messages=duration // 10)
-            )
-            message_tasks.append(task)
-        await asyncio.sleep(duration)
-        self.running = False
-        await asyncio.gather(*client_tasks, *message_tasks, return_exceptions=True)
+        workers = [asyncio.create_task(self._issue_worker()) for _ in range(num_issue_workers)]
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for i in range(num_clients):
+                    tg.create_task(self._delayed_start(i, random.choice(chat_ids)))
+                for chat_id in chat_ids:
+                    tg.create_task(self.send_chat_messages(chat_id, num_messages=duration // 10))
+                await asyncio.sleep(duration)
+                self.running = False
+                for resume in self._client_resume.values():
+                    resume.set()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            while not self._issue_q.empty():
+                self._issue_q.get_nowait()
+                self._issue_q.task_done()
+            self._issue_pending.clear()
         self.print_stats()
 
     def print_stats(self):
@@ -186,21 +291,28 @@ def signal_handler(signum, frame):
 async def main():
     signal.signal(signal.SIGINT, signal_handler)
     tester = CentrifugoStressTester()
+    await tester.start()
     scenarios = [
         {"clients": 5, "chats": 2, "duration": 60, "name": "Light Load"},
         {"clients": 20, "chats": 5, "duration": 120, "name": "Medium Load"},
         {"clients": 50, "chats": 10, "duration": 180, "name": "Heavy Load"},
     ]
-    for scenario in scenarios:
-        logger.info(f"\n=== Running {scenario['name']} ===")
-        tester.stats = {key: 0 for key in tester.stats}
-        tester.running = True
-        await tester.run_stress_test(
-            num_clients=scenario["clients"],
-            num_chats=scenario["chats"],
-            duration=scenario["duration"]
-        )
-        await asyncio.sleep(10)
+    try:
+        for scenario in scenarios:
+            logger.info(f"\n=== Running {scenario['name']} ===")
+            tester.stats = {key: 0 for key in tester.stats}
+            tester.running = True
+            await tester.run_stress_test(
+                num_clients=scenario["clients"],
+                num_chats=scenario["chats"],
+                duration=scenario["duration"]
+            )
+            await asyncio.sleep(10)
+    finally:
+        await tester.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())